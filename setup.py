@@ -11,11 +11,14 @@ setuptools.setup(
     license='MIT',
     install_requires=[
         'numpy>=1.3',
-        'scipy>=0.7',
         'imageio>=2.2',
         'matplotlib>=2.0',
         'sk-video>=1.1'
         ],
+    extras_require={
+        'jit': ['numba>=0.49'],
+        'pyav': ['av'],
+        },
     classifiers=[
         'Development Status :: 3 - Alpha',
         'License :: OSI Approved :: MIT License',
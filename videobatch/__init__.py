@@ -29,24 +29,50 @@ from glob import glob as _glob
 import json as _json
 from traceback import print_exc as _print_exc
 import warnings as _warnings
+import threading as _threading
+import queue as _queue
+from concurrent.futures import ProcessPoolExecutor as _ProcessPoolExecutor
+import subprocess as _sp
 
 import numpy as _np
 from matplotlib.cm import hsv as _hsv
 
-### imsave is deprecated as of scipy 1.1.0
 from imageio import imread as _imread
-from imageio import imwrite as _imsave
+from imageio import imwrite as _imwrite
 
 try:
     ucls = unicode # test if name 'unicode' exists
 except NameError:
     unicode = str
 
+try:
+    import numba as _numba
+except ImportError:
+    _numba = None # falls back to the NumPy-based implementation
+
+try:
+    import av as _av
+except ImportError:
+    _av = None # the 'pyav' backend is unavailable
+
 with _warnings.catch_warnings(record=True):
     _warnings.filterwarnings("ignore", message="avprobe", category=UserWarning)
+    import skvideo as _skvideo
     import skvideo.io as _vio
 
-OUTPUT_SPECS = {"-c:v": "libx264", "-preset": "slow", "-crf": "26"}
+# mask videos consist of flat-colored pixels, and compress well even with the fastest preset
+MASK_OUTPUT_SPECS = {"-c:v": "libx264", "-preset": "ultrafast", "-crf": "28", "-tune": "fastdecode"}
+
+# input options for the mask writer: lets ffmpeg queue up more frames from the pipe
+MASK_INPUT_SPECS = {"-thread_queue_size": "512"}
+
+ENCODER_SPECS = {
+    "libx264":    MASK_OUTPUT_SPECS,
+    "h264_nvenc": {"-c:v": "h264_nvenc", "-preset": "p4", "-cq": "26"},
+}
+
+# the RGB color for each (integer) onset+offset of a hue range, used for painting the mask files
+_HSV_LUT = (_hsv(_np.arange(721)/720)[:,:3]*255).round().astype(_np.uint8)
 
 PROFILE_TIME = False
 
@@ -92,13 +118,131 @@ def force_close(fp):
     except:
         pass
 
+_encoders = None
+def available_encoders():
+    """returns the set of names of the video encoders that the ffmpeg binary provides."""
+    global _encoders
+    if _encoders is None:
+        _encoders = set()
+        cmd = [_os.path.join(_skvideo.getFFmpegPath(), _skvideo._FFMPEG_APPLICATION), "-hide_banner", "-encoders"]
+        try:
+            out = _sp.check_output(cmd, stderr=_sp.STDOUT, universal_newlines=True)
+        except (OSError, _sp.CalledProcessError):
+            out = ""
+        for line in out.splitlines():
+            fields = line.split()
+            if (len(fields) > 1) and fields[0].startswith('V'):
+                _encoders.add(fields[1])
+    return _encoders
+
+_usable = {}
+def encoder_usable(encoder):
+    """returns whether `encoder` can actually encode on this machine, by test-encoding a single frame.
+    (ffmpeg lists e.g. h264_nvenc whenever it is built with it, even where there is no GPU.)"""
+    if encoder not in _usable:
+        if encoder not in available_encoders():
+            _usable[encoder] = False
+        else:
+            # test with the same options as are used for writing the mask files
+            specs = ENCODER_SPECS.get(encoder, {"-c:v": encoder})
+            cmd = [_os.path.join(_skvideo.getFFmpegPath(), _skvideo._FFMPEG_APPLICATION), "-hide_banner",
+                   "-f", "lavfi", "-i", "color=s=256x256", "-frames:v", "1"]
+            for key, val in get_items(specs):
+                cmd.extend((key, val))
+            cmd.extend(("-f", "null", "-"))
+            try:
+                _sp.check_output(cmd, stderr=_sp.STDOUT)
+                _usable[encoder] = True
+            except (OSError, _sp.CalledProcessError):
+                _usable[encoder] = False
+    return _usable[encoder]
+
+def output_specs(encoder="auto"):
+    """returns the ffmpeg output options for writing a video with `encoder`.
+    'auto' selects h264_nvenc if it is usable, and libx264 otherwise."""
+    if string_is_empty(encoder) or (encoder == "auto"):
+        encoder = "h264_nvenc" if encoder_usable("h264_nvenc") else "libx264"
+    return ENCODER_SPECS.get(encoder, {"-c:v": encoder})
+
 def ensure_directory(d):
-    parent, child = _os.path.split(d)
-    if (parent != d) and (len(parent) > 0): # is parent not the drive root?
-        ensure_directory(parent)
-    d = _os.path.join(parent, child)
-    if not _os.path.exists(d):
-        _os.mkdir(d)
+    _os.makedirs(d, exist_ok=True)
+
+def read_into(fp, arr):
+    """fills the (C-contiguous) `arr` with the bytes read from `fp`.
+    returns False upon a clean EOF (i.e. at a frame boundary), and raises RuntimeError upon EOF in the middle of `arr`."""
+    view  = memoryview(arr).cast('B')
+    nread = 0
+    while nread < view.nbytes:
+        n = fp.readinto(view[nread:])
+        if not n:
+            if nread == 0:
+                return False
+            raise RuntimeError("unexpected end of stream: read {0} of {1} bytes of a frame".format(nread, view.nbytes))
+        nread += n
+    return True
+
+class FastFFmpegReader(_vio.FFmpegReader):
+    """an FFmpegReader that reads each frame directly from the ffmpeg pipe
+    into a new ndarray, without going through an intermediate `bytes` object."""
+
+    def nextFrame(self):
+        shape = (self.outputheight, self.outputwidth, self.outputdepth)
+        for i in range(self.inputframenum):
+            frame = _np.empty(shape, dtype=_np.uint8)
+            if not read_into(self._proc.stdout, frame):
+                return
+            yield frame
+
+class ResultWriter(object):
+    """a CSV file of frame-wise results. rows are buffered, and formatted/written in chunks."""
+    chunksize = 100
+    bufsize   = 1 << 20
+
+    def __init__(self, path, columns, chunksize=None):
+        """columns be the names of the value columns (i.e. other than 'Slice')."""
+        if chunksize is not None:
+            self.chunksize = max(int(chunksize), 1)
+        self._fmt  = "%d," + ",".join(["%.4f"]*len(columns)) + "\n"
+        self._rows = []
+        self._fp   = open(path, 'w', buffering=self.bufsize)
+        self._fp.write('Slice,'+','.join(columns))
+        self._fp.write('\n')
+
+    def write(self, i, values):
+        self._rows.append((i,) + tuple(values))
+        if len(self._rows) >= self.chunksize:
+            self.flush()
+
+    def flush(self):
+        fmt = self._fmt
+        self._fp.write("".join(fmt % row for row in self._rows))
+        self._rows = []
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self._fp.close()
+
+class PyAVReader(object):
+    """a frame reader based on PyAV, which lets ffmpeg decode frames using multiple threads
+    (and releases the GIL during decoding)."""
+
+    def __init__(self, path, threads=0):
+        if _av is None:
+            raise RuntimeError("the 'pyav' backend requires PyAV; install it through e.g. 'pip install av'.")
+        self._container = _av.open(path)
+        self._stream = self._container.streams.video[0]
+        self._stream.thread_type = "AUTO"
+        if threads > 0:
+            self._stream.thread_count = threads
+
+    def nextFrame(self):
+        for frame in self._container.decode(self._stream):
+            yield frame.to_ndarray(format='rgb24')
+
+    def close(self):
+        self._container.close()
 
 class Processor(object):
     """an abstraction of a single-file process."""
@@ -108,8 +252,11 @@ class Processor(object):
     reader = None
     procbycount = 100
     sepbycount = 1000
+    prefetch = 4
+    threads = 0
+    backend = "ffmpeg"
 
-    def __init__(self, proc, path, procbycount=None, sepbycount=None):
+    def __init__(self, proc, path, procbycount=None, sepbycount=None, prefetch=None, threads=None, backend=None):
         """proc be an AbstractBatch object; path be a path to the video file."""
         if proc is None:
             raise ValueError("no procedure is specified for Processor")
@@ -124,21 +271,77 @@ class Processor(object):
             self.procbycount = int(procbycount)
         if sepbycount is not None:
             self.sepbycount = int(sepbycount)
+        if prefetch is not None:
+            self.prefetch = int(prefetch)
+        if threads is not None:
+            self.threads = int(threads)
+        if not string_is_empty(backend):
+            if backend not in ("ffmpeg", "pyav"):
+                raise ValueError("unknown backend: '{0}' (must be either 'ffmpeg' or 'pyav')".format(backend))
+            self.backend = backend
 
     def __enter__(self):
-        self.reader = _vio.FFmpegReader(self.path)
+        # ffmpeg already picks the number of decoder threads by itself:
+        # the 'threads' option only takes effect when it is set to a positive number
+        if self.backend == "pyav":
+            self.reader = PyAVReader(self.path, threads=self.threads)
+        elif self.threads > 0:
+            self.reader = FastFFmpegReader(self.path, inputdict={"-threads": str(self.threads)})
+        else:
+            self.reader = FastFFmpegReader(self.path)
         self.proc.__start__(self.name)
         print_status("processing: {0}".format(self.name), end='', flush=True)
+        # decode frames in the background, while the main thread runs __update__
+        self._frames  = _queue.Queue(maxsize=max(self.prefetch, 1))
+        self._stopped = _threading.Event()
+        self._decoder = _threading.Thread(target=self._decode)
+        self._decoder.daemon = True
+        self._decoder.start()
         return self
 
+    def _decode(self):
+        """(runs in the decoder thread) puts (i, frame) items into the queue,
+        followed by (None, <exception or None>) at the end of the file."""
+        err = None
+        try:
+            for item in enumerate(self.reader.nextFrame()):
+                if not self._put(item):
+                    return
+        except Exception as e:
+            err = e
+        self._put((None, err))
+
+    def _put(self, item):
+        """puts the item into the queue unless stopped. returns False if stopped."""
+        while not self._stopped.is_set():
+            try:
+                self._frames.put(item, timeout=0.1)
+                return True
+            except _queue.Full:
+                pass
+        return False
+
     def __iter__(self):
-        for i, frame in enumerate(self.reader.nextFrame()):
-            if (i>0) and (i % (self.sepbycount) == 0):
-                print_status(' ', end='', flush=True)
+        nframes   = 0
+        proc_left = self.procbycount # frames left until the next '.'
+        sep_left  = self.sepbycount  # frames left until the next ' '
+        while True:
+            i, frame = self._frames.get()
+            if i is None:
+                if frame is not None:
+                    raise frame
+                break
             yield i, frame
-            if (i+1) % (self.procbycount) == 0:
+            nframes = i+1
+            proc_left -= 1
+            if proc_left == 0:
                 print_status('.', end='', flush=True)
-        print_status("done ({0}).".format(i+1), flush=True)
+                proc_left = self.procbycount
+            sep_left -= 1
+            if sep_left == 0:
+                print_status(' ', end='', flush=True)
+                sep_left = self.sepbycount
+        print_status("done ({0}).".format(nframes), flush=True)
 
     def __exit__(self, exc, value, trace):
         try:
@@ -147,6 +350,8 @@ class Processor(object):
             print_status("*** {0}".format(e))
             return False
         finally:
+            self._stopped.set()
+            self._decoder.join()
             force_close(self.reader)
         return (exc is None)
 
@@ -162,6 +367,7 @@ class AbstractBatch(object):
     sources = []
     sourcedir = None
     logging = {}
+    workers = 1
 
     def __init__(self, *src, **config):
         if len(src) == 0:
@@ -171,6 +377,10 @@ class AbstractBatch(object):
         if string_is_empty(self.sourcedir):
             self.sourcedir = _os.getcwd()
         self.logging = config.get("logging", {})
+        self.workers = config.get("workers", 1)
+        if self.workers in (0, "auto"):
+            self.workers = _os.cpu_count() or 1
+        self.workers = int(self.workers)
 
     def _expandsources(self):
         for src in self.sources:
@@ -179,10 +389,22 @@ class AbstractBatch(object):
                 yield path
 
     def run(self):
-        for path in self._expandsources():
-            with Processor(self, path, **(self.logging)) as reader:
-                for i, frame in reader:
-                    self.__update__(i, frame)
+        paths = list(self._expandsources())
+        if (self.workers > 1) and (len(paths) > 1):
+            # each worker process runs a copy of this object on its share of the files
+            nworkers = min(self.workers, len(paths))
+            with _ProcessPoolExecutor(max_workers=nworkers) as pool:
+                for result in pool.map(_process_path, [(self, path, nworkers) for path in paths]):
+                    pass
+        else:
+            for path in paths:
+                self.process(path)
+
+    def process(self, path):
+        """processes a single video file."""
+        with Processor(self, path, **(self.logging)) as reader:
+            for i, frame in reader:
+                self.__update__(i, frame)
 
     def __start__(self, name):
         """subclass-specific implementation for movie-wise initialization procedures."""
@@ -196,6 +418,18 @@ class AbstractBatch(object):
         """subclass-specific implementation for movie-wise finalization procedures."""
         print_status("done('{0}', err={1})".format(name, err))
 
+def _process_path(args):
+    """(runs in a worker process) args be a (batch, path, nworkers) tuple.
+    the CPUs are shared among the workers, so that the numba and the ffmpeg threads
+    of all the workers together do not outnumber them."""
+    proc, path, nworkers = args
+    share = max(1, (_os.cpu_count() or 1) // nworkers)
+    if _numba is not None:
+        _numba.set_num_threads(min(share, _numba.config.NUMBA_NUM_THREADS))
+    if int(proc.logging.get("threads", 0) or 0) <= 0:
+        proc.logging = dict(proc.logging, threads=share)
+    proc.process(path)
+
 @command("projection")
 class Projection(AbstractBatch):
     """creates a t-projection image file.
@@ -203,69 +437,70 @@ class Projection(AbstractBatch):
     (parameters)
     <- 'type': one of ("max", "mean", "avg", "scale", "magenta_scale"). 'max' by default.
     <- 'outdir': the directory where the output file(s) will go. defaults to the current directory.
+    <- 'png_compress': the compression level (0-9) of the output PNG file(s). 1 by default.
     """
     outdir = None
     projtype = None
+    png_compress = 1
     _buffer = None
     _outname = None
 
     def __init__(self, *src, sourcedir=None, **config):
-        super(Projection, self).__init__(*src, sourcedir=sourcedir)
+        super(Projection, self).__init__(*src, sourcedir=sourcedir, **config)
         self.outdir = config.get("outdir", None)
         if string_is_empty(self.outdir):
             self.outdir = _os.getcwd()
         self.projtype = config.get("type", None)
         if string_is_empty(self.projtype):
             self.projtype = "max"
+        self.png_compress = int(config.get("png_compress", 1))
 
     def __start__(self, name):
         self._outname = "{0}.png".format(_os.path.splitext(name)[0])
+        self._nframe  = 0
+        self._buffer  = None
         if self.projtype == "magenta_scale":
-            self._blue  = None
-            self._green = None
-            self._red   = None
-        else:
-            self._buffer = None
+            self._rg    = None # the sums of red and green values
+            self._blue  = None # the max of blue values
 
     def __update__(self, i, frame):
         # TODO: check if it is the color image
-        if self._buffer is None:
+        if self._nframe == 0:
             if self.projtype in ("max",):
                 self._buffer = frame.copy()
             elif self.projtype in ("mean", "avg", "scale"):
-                self._buffer = frame.astype(float)
+                self._buffer = frame.astype(_np.uint32)
             elif self.projtype == "magenta_scale":
-                self._buffer = frame.copy()
+                self._rg     = frame[:,:,:2].astype(_np.uint32)
                 self._blue   = frame[:,:,2].copy()
-                self._green  = frame[:,:,1].astype(float).copy()
-                self._red    = frame[:,:,0].astype(float).copy()
         else:
             if self.projtype in ("mean", "avg", "scale"):
-                self._buffer += frame.astype(float)
-                self._nframe  = i
+                _np.add(self._buffer, frame, out=self._buffer, casting='unsafe')
             elif self.projtype == "magenta_scale":
-                self._red   += frame[:,:,0]
-                self._green += frame[:,:,1]
-                self._blue   = _np.nanmax([frame[:,:,2], self._blue], axis=0)
+                _np.add(self._rg, frame[:,:,:2], out=self._rg, casting='unsafe')
+                _np.maximum(self._blue, frame[:,:,2], out=self._blue)
             else:
-                self._buffer = _np.nanmax([frame, self._buffer], axis=0)
+                _np.maximum(self._buffer, frame, out=self._buffer)
+        self._nframe = i + 1
 
     def __done__(self, name, err=False):
         ensure_directory(self.outdir)
         path = _os.path.join(self.outdir, self._outname)
         if self.projtype in ("mean", "avg"):
-            self._buffer = (self._buffer/(self._nframe + 1)).astype(_np.uint8) 
+            self._buffer = (self._buffer // self._nframe).astype(_np.uint8)
         elif self.projtype == "scale":
-            self._buffer /= (self._buffer.max((0,1), keepdims=True))/255
-            self._buffer  = self._buffer.astype(_np.uint8)
+            scaled = self._buffer.astype(_np.float32)
+            scaled /= scaled.max((0,1), keepdims=True)
+            scaled *= 255
+            self._buffer = scaled.astype(_np.uint8)
         elif self.projtype == "magenta_scale":
-            self._red   /= self._red.max()
-            self._green /= self._green.max() 
-            self._buffer = _np.stack([(self._red*255).astype(_np.uint8), (self._green*255).astype(_np.uint8), self._blue], axis=-1)
-            self._red    = None
-            self._green  = None
+            scaled = self._rg.astype(_np.float32)
+            scaled /= scaled.max((0,1), keepdims=True)
+            scaled *= 255
+            self._buffer = _np.concatenate([scaled.astype(_np.uint8), self._blue[:,:,None]], axis=-1)
+            self._rg     = None
             self._blue   = None
-        _imsave(path, self._buffer)
+        _imwrite(path, self._buffer, compress_level=self.png_compress)
         self._buffer = None
         print_status("-> {0}".format(path), flush=True)
 
@@ -278,7 +513,7 @@ class ColorMask(object):
     def __init__(self, onset, offset):
         self.onset = onset
         self.offset = offset
-        self.color = (_np.array(_hsv((self.onset + self.offset)/720)[:-1], dtype=float)*255).round().astype(int)
+        self.color = _HSV_LUT[int(_np.clip(self.onset + self.offset, 0, 720))]
 
     def __repr__(self):
         return "ColorMask({0},{1})".format(self.onset, self.offset)
@@ -290,6 +525,8 @@ class ROI(object):
     """a base representation of a ROI for Pixylation."""
     xpos = _np.array((), dtype=int)
     ypos = _np.array((), dtype=int)
+    _linidx = None
+    _width  = None
 
     def __new__(cls, specs):
         if isinstance(specs, (str, unicode)): # TODO: or path-like??
@@ -305,13 +542,45 @@ class ROI(object):
     def is_empty(self):
         return self.xpos.size == 0
 
+    def check_bounds(self, shape):
+        """raises ValueError if any of the ROI pixels falls outside a frame of `shape`."""
+        if self.is_empty():
+            return
+        height, width = shape[:2]
+        if (self.xpos.min() < 0) or (self.xpos.max() >= width) or (self.ypos.min() < 0) or (self.ypos.max() >= height):
+            raise ValueError("{0} does not fit in the frame ({1}x{2})".format(self, width, height))
+
+    def linear_indices(self, width):
+        """returns the indices of the ROI pixels in a frame of `width`, flattened as (H*W,3)."""
+        if self._width != width:
+            # an x position out of the width would silently point to a pixel in another row
+            if (not self.is_empty()) and ((self.xpos.min() < 0) or (self.xpos.max() >= width)):
+                raise ValueError("{0} does not fit in the frame width ({1})".format(self, width))
+            self._linidx = self.ypos.astype(_np.intp) * width + self.xpos
+            self._width  = width
+        return self._linidx
+
     def crop(self, frame):
         """returns cropped pixels as a (N,3) array"""
-        return frame[self.ypos,self.xpos]
+        return frame.reshape((-1, frame.shape[2])).take(self.linear_indices(frame.shape[1]), axis=0)
+
+    def region(self, frame):
+        """returns the pixels of this ROI in the `frame` (as a view, where possible)"""
+        return self.crop(frame)
 
     def mark(self, frame, mask, value):
         """marks the `mask`-ed pixels within this ROI in the `frame` to `value`"""
-        frame[self.ypos[mask], self.xpos[mask]] = value
+        if frame.flags.c_contiguous:
+            frame.reshape((-1, frame.shape[2]))[self.linear_indices(frame.shape[1])[mask]] = value
+        else:
+            frame[self.ypos[mask], self.xpos[mask]] = value
+
+    def clear(self, frame):
+        """sets all the pixels within this ROI in the `frame` to zero"""
+        if frame.flags.c_contiguous:
+            frame.reshape((-1, frame.shape[2]))[self.linear_indices(frame.shape[1])] = 0
+        else:
+            frame[self.ypos, self.xpos] = 0
 
 class RectangularROI(ROI):
     """a representation of a rectangular ROI for Pixylation."""
@@ -333,6 +602,22 @@ class RectangularROI(ROI):
         self.ypos  = yvals.flatten()
         print(self.xpos)
 
+    def crop(self, frame):
+        """returns cropped pixels as a (N,3) array, by slicing the rectangle out of the `frame`"""
+        return frame[self.y:(self.y + self.h), self.x:(self.x + self.w)].reshape((-1, frame.shape[2]))
+
+    def region(self, frame):
+        """returns the pixels of this ROI in the `frame` (as a view, where possible)"""
+        return frame[self.y:(self.y + self.h), self.x:(self.x + self.w)]
+
+    def mark(self, frame, mask, value):
+        """marks the `mask`-ed pixels within this ROI in the `frame` to `value`"""
+        frame[self.y:(self.y + self.h), self.x:(self.x + self.w)][mask.reshape((self.h, self.w))] = value
+
+    def clear(self, frame):
+        """sets all the pixels within this ROI in the `frame` to zero"""
+        frame[self.y:(self.y + self.h), self.x:(self.x + self.w)] = 0
+
     def __repr__(self):
         return "RectangularROI(dict(x={0},y={1},w={2},h={3}))".format(self.x, self.y, self.w, self.h)
 
@@ -350,47 +635,142 @@ class MaskROI(ROI):
     def __repr__(self):
         return "MaskROI('{}')".format(self.path)
 
-_Htable = None
-_Ltable = None
-def _initialize_tables():
-    global _Htable, _Ltable
-    if _Htable is None:
-        print_status("initializing the hue/luma tables...", end='', flush=True)
-        _Htable = _np.empty((256, 256, 256), dtype=int)
-        _values = _np.arange(256)
-        _RGB = _np.empty((256,256,256,3), dtype=int)
-        _RGB[:,:,:,0] = _values.reshape((-1,1,1)) # R
-        _RGB[:,:,:,1] = _values.reshape((1,-1,1)) # G
-        _RGB[:,:,:,2] = _values.reshape((1,1,-1)) # B
-        M = _RGB.max(axis=3)
-        m = _RGB.min(axis=3)
-        D = M - m
-
-        done = (D == 0);
-        _Htable[done] = -1
-        rng = _np.logical_and(m == _RGB[:,:,:,2], ~done)
-        _Htable[rng] = _np.around(60*(1 + (_RGB[rng,1] - _RGB[rng,0])/(D[rng]) )).astype(int)
-        done = _np.logical_or(rng, done)
-        rng = _np.logical_and(m == _RGB[:,:,:,0], ~done)
-        _Htable[rng] = _np.around(60*(3 + (_RGB[rng,2] - _RGB[rng,1])/(D[rng]) )).astype(int)
-        done = _np.logical_or(rng, done)
-        rng = ~done
-        _Htable[rng] = _np.around(60*(5 + (_RGB[rng,0] - _RGB[rng,2])/(D[rng]) )).astype(int)
-
-        _Ltable = (0.212*_RGB[:,:,:,0] + 0.701*_RGB[:,:,:,1] + 0.087*_RGB[:,:,:,2])/255
-        print_status("done.", flush=True)
-
+def pack_ROIs(rois):
+    """packs the pixel positions of the ROIs into contiguous arrays.
+    returns (xpos, ypos, offsets), where the pixels of the r-th ROI
+    are found at `offsets[r]:offsets[r+1]`."""
+    rois = list(rois)
+    xpos = _np.concatenate([roi.xpos for roi in rois]).astype(_np.intp)
+    ypos = _np.concatenate([roi.ypos for roi in rois]).astype(_np.intp)
+    offsets = _np.cumsum([0,] + [roi.xpos.size for roi in rois])
+    return xpos, ypos, offsets
+
+_LUMA = _np.array((0.212, 0.701, 0.087), dtype=_np.float32)/255
+
+def as_HL(values):
+    """returns the hue and lightness values for an array of RGB values (with the last axis being RGB)"""
+    R = values[...,0].astype(_np.int16)
+    G = values[...,1].astype(_np.int16)
+    B = values[...,2].astype(_np.int16)
+    M = _np.maximum(_np.maximum(R, G), B)
+    m = _np.minimum(_np.minimum(R, G), B)
+    D = (M - m).astype(_np.float64) # float32 would move some hues across the .5 rounding ties
+    valid = (D != 0)
+
+    # select the numerator and the sector of the hue first, and then divide only once
+    minB = (m == B)
+    minR = (m == R)
+    num  = _np.where(minB, G - R, _np.where(minR, B - G, R - B))
+    base = _np.where(minB, 1, _np.where(minR, 3, 5)).astype(_np.float64)
+    frac = _np.divide(num, D, out=_np.zeros_like(D), where=valid)
+    H = _np.around(60*(base + frac)).astype(_np.int16)
+    H[~valid] = -1
+    L = _np.dot(values, _LUMA)
+    return H, L
 
 def frame_as_HL(frame):
     """returns the hue and lightness values for a (M,N,3) frame"""
-    return _Htable[frame[:,:,0],frame[:,:,1],frame[:,:,2]], _Ltable[frame[:,:,0], frame[:,:,1], frame[:,:,2]]
+    return as_HL(frame)
 
 def vector_as_HL(vec):
     """returns the hue and lightness values for a (N,3) vector of values"""
-    return _Htable[vec[:,0],vec[:,1],vec[:,2]], _Ltable[vec[:,0],vec[:,1],vec[:,2]]
+    return as_HL(vec)
+
+if _numba is not None:
+    @_numba.njit(cache=True)
+    def _pixel_HL(r, g, b):
+        """the scalar version of as_HL(): returns the hue and lightness values of a pixel."""
+        # (signed, so that e.g. `g - r` does not wrap around for uint8 inputs)
+        r = _np.int64(r)
+        g = _np.int64(g)
+        b = _np.int64(b)
+        M = max(r, g, b)
+        m = min(r, g, b)
+        D = M - m
+        L = (0.212*r + 0.701*g + 0.087*b)/255
+        if D == 0:
+            return -1, L
+        elif m == b:
+            H = 60*(1 + (g - r)/D)
+        elif m == r:
+            H = 60*(3 + (b - g)/D)
+        else:
+            H = 60*(5 + (r - b)/D)
+        return int(_np.rint(H)), L
+
+    @_numba.njit(parallel=True, fastmath=True, cache=True)
+    def _pixylate(frame, xpos, ypos, roi_offsets, onsets, offsets, colors, M, sums, nchunk):
+        """computes the (weight, weight*x, weight*y) sums for every ROI/mask pair into `sums`,
+        and paints every ROI pixel in `M` (with the color of the matched mask, or zero).
+
+        the pixels of the r-th ROI are found at `roi_offsets[r]:roi_offsets[r+1]`
+        in the packed `xpos` and `ypos` vectors. they are not bounds-checked here,
+        and must all fall inside the frame.
+
+        all the ROIs are processed in parallel, each split into `nchunk` chunks (i.e. the number of threads).
+        where ROIs overlap, a pixel may be painted by more than one thread, but always with the same
+        color (i.e. that of the last matching mask), as in the serial version."""
+        nroi    = roi_offsets.size - 1
+        nmask   = onsets.size
+        partial = _np.zeros((nroi, nchunk, nmask, 3))
+        for w in _numba.prange(nroi * nchunk):
+            r     = w // nchunk
+            c     = w % nchunk
+            start = roi_offsets[r]
+            stop  = roi_offsets[r+1]
+            step  = (stop - start + nchunk - 1) // nchunk
+            for p in range(start + c*step, min(start + (c+1)*step, stop)):
+                y  = ypos[p]
+                x  = xpos[p]
+                hv, lv = _pixel_HL(frame[y,x,0], frame[y,x,1], frame[y,x,2])
+                matched = -1
+                for k in range(nmask):
+                    if (hv >= onsets[k]) and (hv < offsets[k]):
+                        partial[r,c,k,0] += lv
+                        partial[r,c,k,1] += x*lv
+                        partial[r,c,k,2] += y*lv
+                        matched = k
+                if matched >= 0:
+                    M[y,x,:] = colors[matched]
+                else:
+                    M[y,x,:] = 0
+        for r in range(nroi):
+            for c in range(nchunk):
+                for k in range(nmask):
+                    for j in range(3):
+                        sums[r,k,j] += partial[r,c,k,j]
+    @_numba.njit(cache=True)
+    def _vector_HL(vec, H, L):
+        """fills `H` and `L` with the hue and lightness values for a (N,3) vector of values, using _pixel_HL()"""
+        for p in range(vec.shape[0]):
+            H[p], L[p] = _pixel_HL(vec[p,0], vec[p,1], vec[p,2])
+else:
+    _pixylate = None
+    _vector_HL = None
+
+def check_jit():
+    """checks that the JIT-compiled routine gives the same hue and lightness values
+    as the NumPy-based one (i.e. as_HL()) for every 24-bit color.
+    raises RuntimeError if numba is not installed, or if any of the colors mismatches."""
+    if _vector_HL is None:
+        raise RuntimeError("numba is not installed")
+    vec = _np.empty((256*256, 3), dtype=_np.uint8)
+    vec[:,0] = _np.repeat(_np.arange(256), 256)
+    vec[:,1] = _np.tile(_np.arange(256), 256)
+    H = _np.empty(vec.shape[0], dtype=_np.int64)
+    L = _np.empty(vec.shape[0], dtype=_np.float64)
+    mismatch = 0
+    for b in range(256):
+        vec[:,2] = b
+        _vector_HL(vec, H, L)
+        refH, refL = as_HL(vec)
+        mismatch += _np.count_nonzero((H != refH) | ~_np.isclose(L, refL))
+    if mismatch > 0:
+        raise RuntimeError("the JIT-compiled routine mismatches for {0} colors".format(mismatch))
+    print_status("the JIT-compiled routine matches for all the colors.")
 
 def _mask_entries(maskname):
-    return "{0}_CM_X,{0}_CM_Y".format(maskname)
+    return ("{0}_CM_X".format(maskname), "{0}_CM_Y".format(maskname))
 
 @command("pixylation")
 class Pixylation(AbstractBatch):
@@ -405,6 +785,10 @@ class Pixylation(AbstractBatch):
                a free-shape region can be specified as a path to a B/W image (white pixels will be taken).
     <- 'maskdir': the directory where the mask file(s) will go. defaults to the current directory.
     <- 'resultdir': the directory where the result file(s) will go. defaults to the current directory.
+    <- 'encoder': the ffmpeg encoder for the mask file(s), e.g. "libx264" or "h264_nvenc".
+                  defaults to "auto" (h264_nvenc if it works on this machine, otherwise libx264).
+                  with "auto", a video falls back to libx264 if h264_nvenc fails on its first frames
+                  (e.g. when parallel 'workers' exceed the number of encoder sessions of the GPU).
     """
 
     masks = {}
@@ -412,6 +796,8 @@ class Pixylation(AbstractBatch):
     mode      = None
     maskdir   = None
     resultdir = None
+    encoder   = "auto"
+    maskbatch = 8 # the number of mask frames written to ffmpeg at once
 
     _maskfiles = {}
     _masknames = []
@@ -426,6 +812,7 @@ class Pixylation(AbstractBatch):
         self.resultdir = config.get("resultdir", None)
         if string_is_empty(self.resultdir):
             self.resultdir = _os.getcwd()
+        self.encoder = config.get("encoder", "auto")
 
         self.masks = dict([(k, ColorMask(*v)) for k, v in get_items(config.get("colors", {}))])
         self.ROIs  = dict([(k, ROI(v)) for k, v in get_items(config.get("ROIs", {}))])
@@ -434,7 +821,6 @@ class Pixylation(AbstractBatch):
             raise RuntimeError("No color masks found in the configuration; make sure that you have the 'colors' field in it.")
         if len(self.ROIs) == 0:
             raise RuntimeError("No ROI settings found in the configuration; make sure that you have the 'ROIs' field in it.")
-        _initialize_tables()
 
     def __repr__(self):
         info = ["<< Pixylation >>", "[Colors]"]
@@ -459,53 +845,144 @@ class Pixylation(AbstractBatch):
             resultpath = _os.path.join(self.resultdir, "Results_{0}_{1}.csv".format(basename, roiname))
             # TODO: create mask file
             try:
-                self._resultfiles[roiname] = open(resultpath, 'w')
-                self._resultfiles[roiname].write('Slice,'+','.join(_mask_entries(m) for m in self._masknames))
-                self._resultfiles[roiname].write('\n')
+                self._resultfiles[roiname] = ResultWriter(resultpath,
+                                                          [e for m in self._masknames for e in _mask_entries(m)],
+                                                          chunksize=self.logging.get("procbycount", None))
             except:
                 _print_exc()
                 print_status("*** could not open: {0}".format(resultpath))
         if len(self._resultfiles) == 0:
             raise RuntimeError("nothing to output for {0}".format(name))
 
+        # pack the ROIs and the masks into contiguous arrays
+        self._roinames = tuple(roiname for roiname in self.ROIs.keys() if roiname in self._resultfiles.keys())
+        self._xpos, self._ypos, self._roi_offsets = pack_ROIs(self.ROIs[roiname] for roiname in self._roinames)
+        masks = [self.masks[maskname] for maskname in self._masknames]
+        self._onsets  = _np.array([mask.onset for mask in masks], dtype=_np.int16)
+        self._offsets = _np.array([mask.offset for mask in masks], dtype=_np.int16)
+        self._colors  = _np.array([mask.color for mask in masks], dtype=_np.uint8)
+        # (N,2) pixel coordinates of each ROI, for computing the centroids
+        self._coords  = dict((roiname, _np.stack([self.ROIs[roiname].xpos, self.ROIs[roiname].ypos], axis=1).astype(float))
+                             for roiname in self._roinames)
+        self._M       = None # allocated upon the first frame
+
+        # if the hue ranges do not overlap, every pixel matches at most one mask:
+        # `_edges` and `_labels` then map a hue to the index of its mask (or nmask if none)
+        order = _np.argsort(self._onsets, kind='stable')
+        edges = _np.stack([self._onsets[order], self._offsets[order]], axis=1).ravel()
+        if _np.all(_np.diff(edges) >= 0):
+            self._edges  = edges
+            self._labels = _np.full(edges.size + 1, len(masks), dtype=_np.intp)
+            self._labels[1::2] = order
+        else:
+            self._edges  = None
+            self._labels = None
+
         # maskpath = _os.path.join(self.maskdir, "MASK_{0}.avi".format(basename, roiname))
         maskpath = _os.path.join(self.maskdir, "MASK_{0}.mp4".format(basename, roiname))
+        self._maskpath    = maskpath
+        self._maskspecs   = output_specs(self.encoder)
+        self._maskwritten = False
         try:
-            self._maskfile = _vio.FFmpegWriter(maskpath, outputdict=OUTPUT_SPECS)
+            self._open_maskfile()
         except:
             _print_exc()
             print_status("*** could not open: {0}".format(maskpath))
 
-    def __update__(self, i, frame):
-        M = _np.zeros(frame.shape, dtype=int)
-        for roiname, roi in get_items(self.ROIs):
-            if roiname not in self._resultfiles.keys():
-                continue
-            values = [] # placeholder for positions for each of the masks
+    def _open_maskfile(self):
+        # (FFmpegWriter adds the frame size etc. to the dicts it is given: pass copies)
+        self._maskfile = _vio.FFmpegWriter(self._maskpath, inputdict=dict(MASK_INPUT_SPECS),
+                                           outputdict=dict(self._maskspecs))
 
-            # prepare clipped xpos, ypos, H, L that corresponds to the ROI
-            roi_H, roi_L = vector_as_HL(roi.crop(frame))
-            
-            # check for color masks
-            for maskname, colormask in get_items(self.masks):
-                roi_match = colormask.apply(roi_H)
-                if _np.count_nonzero(roi_match) > 0:
-                    match_weight = roi_L[roi_match]
-                    match_x = roi.xpos[roi_match]
-                    match_y = roi.ypos[roi_match]
-                    xrepr = (match_x*match_weight).sum()/(match_weight.sum())
-                    yrepr = (match_y*match_weight).sum()/(match_weight.sum())
-                    values.append(xrepr+1)
-                    values.append(yrepr+1)
-                    roi.mark(M,roi_match,colormask.color)
-                else:
-                    values.append(_np.nan)
-                    values.append(_np.nan)
-            self._resultfiles[roiname].write("{0},".format(i)+','.join("{0:.4f}".format(v) for v in values) + '\n')
+    def _write_masks(self, frames):
+        """writes the mask `frames` to the mask file. if the automatically selected encoder
+        fails on the first frames (e.g. when the GPU runs out of encoder sessions), retries with libx264."""
+        try:
+            self._maskfile.writeFrame(frames)
+        except Exception:
+            fallback = ENCODER_SPECS["libx264"]
+            if self._maskwritten or (not string_is_empty(self.encoder) and (self.encoder != "auto")) \
+                    or (self._maskspecs == fallback):
+                raise
+            print_status("*** could not encode with {0}; falling back to libx264".format(self._maskspecs["-c:v"]))
+            force_close(self._maskfile)
+            self._maskspecs = fallback
+            self._open_maskfile()
+            self._maskfile.writeFrame(frames)
+        self._maskwritten = True
+
+    def __update__(self, i, frame):
+        # mask frames are painted into the slots of `_M`, and written to ffmpeg once all the slots are filled.
+        # only the ROI pixels are ever painted, and they are re-painted (or cleared) on every frame
+        if self._M is None:
+            for roiname in self._roinames:
+                self.ROIs[roiname].check_bounds(frame.shape)
+            nslots = self.maskbatch if self._maskfile is not None else 1
+            self._M    = _np.zeros((max(nslots, 1),) + frame.shape, dtype=_np.uint8)
+            self._slot = 0
+        M = self._M[self._slot]
+        if _pixylate is None:
+            results = self._match_numpy(frame, M)
+        else:
+            results = self._match_numba(frame, M)
+        for roiname, values in zip(self._roinames, results):
+            self._resultfiles[roiname].write(i, values)
         if self._maskfile is not None:
-            self._maskfile.writeFrame(M)
+            self._slot += 1
+            if self._slot == self._M.shape[0]:
+                self._write_masks(self._M)
+                self._slot = 0
+
+    def _match_numba(self, frame, M):
+        """returns the (nROI, 2*nmask) positions, using the JIT-compiled kernel."""
+        sums = _np.zeros((len(self._roinames), len(self._masknames), 3))
+        _pixylate(frame, self._xpos, self._ypos, self._roi_offsets,
+                  self._onsets, self._offsets, self._colors, M, sums, _numba.get_num_threads())
+        with _np.errstate(divide='ignore', invalid='ignore'):
+            positions = sums[:,:,1:] / sums[:,:,:1] + 1
+        return positions.reshape((len(self._roinames), -1))
+
+    def _match_numpy(self, frame, M):
+        """returns the (nROI, 2*nmask) positions, using NumPy routines."""
+        onsets  = self._onsets[:,None]
+        offsets = self._offsets[:,None]
+        results = []
+        for roiname in self._roinames:
+            roi = self.ROIs[roiname]
+
+            # prepare clipped H, L that corresponds to the ROI
+            roi_H, roi_L = vector_as_HL(roi.crop(frame))
+            roi.clear(M)
+
+            coords = self._coords[roiname]
+            if self._edges is not None:
+                # classify each pixel into (at most) one mask, and sum up the weights for all masks at once
+                nmask = len(self._masknames)
+                ids   = self._labels[_np.searchsorted(self._edges, roi_H, side='right')]
+                total = _np.bincount(ids, weights=roi_L, minlength=nmask+1)[:nmask]
+                xsum  = _np.bincount(ids, weights=roi_L*coords[:,0], minlength=nmask+1)[:nmask]
+                ysum  = _np.bincount(ids, weights=roi_L*coords[:,1], minlength=nmask+1)[:nmask]
+                with _np.errstate(divide='ignore', invalid='ignore'):
+                    positions = _np.stack([xsum, ysum], axis=1)/total[:,None]
+                roi_match = (ids < nmask)
+                roi.mark(M, roi_match, self._colors[ids[roi_match]])
+            else:
+                # check for all the color masks at once: (nmask, N)
+                roi_match = _np.logical_and(roi_H >= onsets, roi_H < offsets)
+                match_weight = roi_match * roi_L.astype(_np.float64) # sum up in float64, as in the JIT path
+                with _np.errstate(divide='ignore', invalid='ignore'):
+                    positions = _np.dot(match_weight, coords)/match_weight.sum(axis=1)[:,None]
+                for k in _np.flatnonzero(roi_match.any(axis=1)):
+                    roi.mark(M, roi_match[k], self._colors[k])
+            results.append((positions+1).ravel())
+        return results
 
     def __done__(self, name, err=False):
+        if (self._maskfile is not None) and (self._M is not None) and (self._slot > 0):
+            try:
+                self._write_masks(self._M[:self._slot])
+            except:
+                _print_exc()
         for files in (dict(file=self._maskfile), self._resultfiles):
             for fp in files.values():
                 force_close(fp)
@@ -514,7 +991,27 @@ from collections import OrderedDict
 
 def get_value(roi, frame):
     """add-on method for getting the value of ROI in the frame"""
-    return frame[(roi.x):(roi.x + roi.w), (roi.y):(roi.y + roi.h), :].mean()
+    pixels = roi.region(frame)
+    return pixels.sum(dtype=_np.uint64) / pixels.size
+
+if _numba is not None:
+    @_numba.njit(parallel=True, cache=True)
+    def _mean_rois(frame, xpos, ypos, roi_offsets, out):
+        """computes the mean pixel value of each of the packed ROIs into `out`.
+        the pixel positions are not bounds-checked here, and must all fall inside the frame."""
+        nchan = frame.shape[2]
+        for r in _numba.prange(roi_offsets.size - 1):
+            npix  = roi_offsets[r+1] - roi_offsets[r]
+            if npix == 0:
+                out[r] = _np.nan
+                continue
+            total = 0
+            for p in range(roi_offsets[r], roi_offsets[r+1]):
+                for c in range(nchan):
+                    total += frame[ypos[p], xpos[p], c]
+            out[r] = total / (npix * nchan)
+else:
+    _mean_rois = None
 
 @command("profile")
 class Profile(AbstractBatch):
@@ -531,13 +1028,19 @@ class Profile(AbstractBatch):
     resultdir   = None
 
     def __init__(self, *src, **config):
+        super(Profile, self).__init__(*src, **config)
         self.resultdir = config.get("outdir", None)
         if string_is_empty(self.resultdir):
             self.resultdir = _os.getcwd()
         self.ROIs = dict([(k, ROI(v)) for k, v in get_items(config.get("ROIs", {}))])
         print("{0}".format(self))
-        if len(self.ROIS) == 0:
+        if len(self.ROIs) == 0:
             raise RuntimeError("No ROI settings found in the configuration; make sure that you have the 'ROIs' field in it.")
+        self._xpos, self._ypos, self._roi_offsets = pack_ROIs(self.ROIs.values())
+        self._npixels  = _np.diff(self._roi_offsets)
+        self._nonempty = (self._npixels > 0)
+        self._linidx   = None
+        self._width    = None
 
     def __repr__(self):
         info = ["<< Profile >>"]
@@ -552,15 +1055,35 @@ class Profile(AbstractBatch):
 
         resultpath = _os.path.join(self.resultdir, "Profile_{}.csv".format(basename))
         try:
-            self._resultfile = open(resultpath, 'w')
-            self._resultfile.write('Slice,'+','.join(self.ROIs.keys()))
-            self._resultfile.write('\n')
+            self._resultfile = ResultWriter(resultpath, list(self.ROIs.keys()),
+                                            chunksize=self.logging.get("procbycount", None))
         except:
             _print_exc()
             raise RuntimeError("could not open: {0}".format(resultpath))
 
     def __update__(self, i, frame):
-        self._resultfile.write("{0},".format(i)+','.join("{0:.4f}".format(v) for v in [get_value(roi, frame) for roi in get_items(self.ROIs)]) + '\n')
+        if i == 0:
+            for roi in self.ROIs.values():
+                roi.check_bounds(frame.shape)
+        if _mean_rois is None:
+            values = self._mean_numpy(frame)
+        else:
+            values = _np.empty(len(self.ROIs))
+            _mean_rois(frame, self._xpos, self._ypos, self._roi_offsets, values)
+        self._resultfile.write(i, values)
+
+    def _mean_numpy(self, frame):
+        """returns the mean pixel values of all the ROIs, summing up the packed ROI pixels in one pass."""
+        if self._width != frame.shape[1]:
+            self._width  = frame.shape[1]
+            self._linidx = self._ypos * self._width + self._xpos
+        values = _np.full(len(self.ROIs), _np.nan)
+        if _np.any(self._nonempty):
+            pixels = frame.reshape((-1, frame.shape[2])).take(self._linidx, axis=0).sum(axis=1, dtype=_np.uint64)
+            # empty ROIs are skipped, so that each segment starts at a valid index
+            sums   = _np.add.reduceat(pixels, self._roi_offsets[:-1][self._nonempty])
+            values[self._nonempty] = sums / (self._npixels[self._nonempty] * frame.shape[2])
+        return values
 
     def __done__(self, name, err=False):
         force_close(self._resultfile)
@@ -568,6 +1091,7 @@ class Profile(AbstractBatch):
 def print_usage():
     print("[usage]")
     print("    python {0} <path/to/config-file.json>".format(*(_sys.argv)))
+    print("    python {0} --check-jit  (checks the JIT-compiled routine against the NumPy-based one)".format(*(_sys.argv)))
     print()
     print("[base parameters]")
     print("the JSON file must consist of a dictionary that contains the following keys and values: ")
@@ -575,6 +1099,7 @@ def print_usage():
     for param, desc in (("command", "(required) the command to run. see below for details."),
                         ("sources", "(required) list or pattern(s) of file names to perform conversion."),
                         ("sourcedir", "(optional) the directory where the program searches for the video. defaults to the current directory."),
+                        ("workers", "(optional) the number of video files to be processed in parallel (0 or \"auto\" for the number of CPUs). defaults to 1."),
                         ):
         print("{0:>15}: {1}".format("'{}'".format(param), desc))
     print()
@@ -23,11 +23,13 @@
 #
 
 import sys as _sys
-from videobatch import run, print_usage, set_profile_time
+from videobatch import run, print_usage, set_profile_time, check_jit
 
 def main():
     global PROFILE_TIME
-    if len(_sys.argv) == 2:
+    if (len(_sys.argv) == 2) and (_sys.argv[1] == '--check-jit'):
+        check_jit()
+    elif len(_sys.argv) == 2:
         run(_sys.argv[1])
     elif (len(_sys.argv) == 3) and (_sys.argv[1] in ('-t','--time')):
         set_profile_time(True)